@@ -1,43 +1,162 @@
+from __future__ import annotations
+
 import os
 import re
+import sys
 import json
+import asyncio
+import sqlite3
+import threading
 import logging
+import operator
+import functools
+from itertools import count, groupby
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ConversationHandler, ContextTypes, filters
-)
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+if TYPE_CHECKING:
+    # telegram.ext тянет за собой почти всю библиотеку — импортируем его в main()
+    from telegram.ext import ContextTypes
+
 logger = logging.getLogger(__name__)
 
 TOKEN = os.environ.get("BOT_TOKEN", "")
-DATA_FILE = "employees.json"
+DATA_FILE = "employees.sqlite"
 
-# Conversation states
-ASK_FLOOR, ASK_ROOM = range(2)
+# Состояния диалога (context.user_data["state"]); None — ждём отбивку.
+# ADD_* — ручное добавление через /add.
+ASK_FLOOR, ASK_ROOM, ADD_FLOOR, ADD_ROOM = range(4)
 
 
 # ─────────────────────────────────────────────────────────
-# БАЗА СОТРУДНИКОВ
-# { "батталова": {"full_name": "Батталова Лейла", "floor": 12, "room": "12.43"} }
+# БАЗА СОТРУДНИКОВ (SQLite)
+# emp: surname="батталова", full_name="Батталова Лейла", floor=12, room="12.43"
 # ─────────────────────────────────────────────────────────
 
-def load_db() -> dict:
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# Старый формат: { "батталова": {"full_name": ..., "floor": ..., "room": ...} }.
+# Если он лежит рядом, а таблица пустая — переносим данные при первом открытии
+# и переименовываем файл, чтобы не импортировать его повторно.
+LEGACY_DATA_FILE = "employees.json"
+
+# Одно соединение на процесс. Запросы идут из потоков asyncio.to_thread,
+# поэтому соединение не привязано к потоку, а доступ к нему — под замком.
+_DB_CONN: sqlite3.Connection | None = None
+_DB_LOCK = threading.Lock()
+
+def _read_legacy_db() -> list | None:
+    """Строки для emp из старого employees.json или None, если импортировать нечего."""
+    if not os.path.exists(LEGACY_DATA_FILE):
+        return None
+    try:
+        with open(LEGACY_DATA_FILE, encoding="utf-8") as f:
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        logger.warning("Не удалось прочитать %s, импорт пропущен", LEGACY_DATA_FILE)
+        return None
+    if not isinstance(legacy, dict):
+        logger.warning("%s не похож на базу сотрудников, импорт пропущен", LEGACY_DATA_FILE)
+        return None
+    rows = []
+    for surname, info in legacy.items():
+        # Без этажа и комнаты сотрудника не поставить в маршрут — пусть бот спросит заново
+        if (not isinstance(info, dict) or not isinstance(info.get("floor"), int)
+                or not isinstance(info.get("room"), str)):
+            continue
+        rows.append((normalize(surname), info.get("full_name") or surname.capitalize(),
+                     info["floor"], info["room"]))
+    return rows
+
+def _open_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(DATA_FILE, check_same_thread=False)
+    imported = False
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS emp("
+            "surname TEXT PRIMARY KEY, full_name TEXT, floor INT, room TEXT)"
+        )
+        if conn.execute("SELECT 1 FROM emp LIMIT 1").fetchone() is None:
+            rows = _read_legacy_db()
+            if rows is not None:
+                conn.executemany("INSERT OR REPLACE INTO emp VALUES (?, ?, ?, ?)", rows)
+                imported = True
+    if imported:
+        os.replace(LEGACY_DATA_FILE, LEGACY_DATA_FILE + ".imported")
+        logger.info("Импортировано сотрудников из %s: %d", LEGACY_DATA_FILE, len(rows))
+    return conn
+
+def _get_conn() -> sqlite3.Connection:
+    global _DB_CONN
+    if _DB_CONN is None:
+        _DB_CONN = _open_db()
+    return _DB_CONN
+
+def _run(fn, *args):
+    with _DB_LOCK:
+        conn = _get_conn()
+        with conn:
+            return fn(conn, *args)
+
+def _get_employees(conn, surnames: list) -> dict:
+    placeholders = ", ".join("?" * len(surnames))
+    rows = conn.execute(
+        f"SELECT surname, full_name, floor, room FROM emp WHERE surname IN ({placeholders})",
+        surnames
+    )
+    return {surname: {"full_name": full_name, "floor": floor, "room": room}
+            for surname, full_name, floor, room in rows}
+
+def _list_employees(conn) -> list:
+    return conn.execute(
+        "SELECT surname, full_name, floor, room FROM emp "
+        "ORDER BY floor IS NULL, floor, room"
+    ).fetchall()
+
+def _save_employee(conn, surname: str, full_name: str, floor: int, room: str):
+    conn.execute(
+        "INSERT OR REPLACE INTO emp VALUES (?, ?, ?, ?)",
+        (surname, full_name, floor, room)
+    )
+
+def _delete_employee(conn, surname: str) -> str | None:
+    row = conn.execute("SELECT full_name FROM emp WHERE surname = ?", (surname,)).fetchone()
+    if row is None:
+        return None
+    conn.execute("DELETE FROM emp WHERE surname = ?", (surname,))
+    return row[0] or surname
 
-def save_db(data: dict):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+async def get_employees(surnames: list) -> dict:
+    if not surnames:
+        return {}
+    return await asyncio.to_thread(_run, _get_employees, surnames)
+
+async def list_employees() -> list:
+    """[(surname, full_name, floor, room)], по этажу и комнате; без этажа — в конце."""
+    return await asyncio.to_thread(_run, _list_employees)
+
+async def save_employee(surname: str, full_name: str, floor: int, room: str):
+    await asyncio.to_thread(_run, _save_employee, surname, full_name, floor, room)
+
+async def delete_employee(surname: str) -> str | None:
+    """Имя удалённого сотрудника или None, если такого нет."""
+    return await asyncio.to_thread(_run, _delete_employee, surname)
+
+def _close_db():
+    global _DB_CONN
+    with _DB_LOCK:
+        if _DB_CONN is not None:
+            _DB_CONN.close()
+            _DB_CONN = None
+
+async def warm_db(app=None):
+    await asyncio.to_thread(_run, lambda conn: None)
+
+async def close_db(app=None):
+    await asyncio.to_thread(_close_db)
 
 def normalize(name: str) -> str:
-    return name.strip().lower()
+    # Фамилии — ключи базы; интернированные строки сравниваются по указателю
+    return sys.intern(name.strip().casefold())
 
 
 # ─────────────────────────────────────────────────────────
@@ -47,20 +166,25 @@ def normalize(name: str) -> str:
 # батталова - 0835
 # ─────────────────────────────────────────────────────────
 
+# Имя берётся жадно: в его классе нет ни цифр, ни длинных тире, поэтому
+# граница с номером заказа однозначна и движку не нужно перебирать варианты.
+# Хвостовые пробелы и дефисы срезаются уже после матча.
+_DELIVERY_RE = re.compile(
+    r"^([а-яёА-ЯЁa-zA-Z][а-яёА-ЯЁa-zA-Z\s\-]+)(?:[–—]\s*)?(\d{3,6})$"
+)
+
 def parse_delivery(text: str) -> list:
     results = []
     for line in text.strip().split("\n"):
         line = line.strip()
-        if not line:
+        # Без цифр номера заказа быть не может — регулярку не запускаем
+        if not any(ch.isdigit() for ch in line):
             continue
-        match = re.match(
-            r"^([а-яёА-ЯЁa-zA-Z][а-яёА-ЯЁa-zA-Z\s\-]+?)\s*[-–—]?\s*(\d{3,6})\s*$",
-            line
-        )
+        match = _DELIVERY_RE.match(line)
         if match:
-            raw_name = match.group(1).strip()
-            order = match.group(2).strip()
-            surname = raw_name.split()[0].lower()
+            raw_name = match.group(1).rstrip().rstrip("-").rstrip()
+            order = match.group(2)
+            surname = normalize(raw_name.split()[0])
             results.append({
                 "name": raw_name,
                 "surname": surname,
@@ -73,58 +197,131 @@ def parse_delivery(text: str) -> list:
 # МАРШРУТ: сортировка по этажу, затем по комнате
 # ─────────────────────────────────────────────────────────
 
+def _parse_room_num(room: str) -> int:
+    # "12.43" -> 43; всё, что не похоже на номер комнаты, — в конец этажа
+    _, _, num = room.partition(".")
+    return int(num) if num.isdecimal() else 99
+
+
+ROUTE_HEADER = "🗺 *МАРШРУТ*\n"
+ROUTE_FLOOR = "🔼 *Этаж {}*"
+ROUTE_LINE = "  {}\\. {}"
+ROUTE_ITEM = "{} — ком\\. {} \\| заказ \\#{}"
+ROUTE_TOTAL = "\n📦 Итого: {} доставок, {} этажей"
+
+
+# Номера доставок для callback_data: уникальны в пределах процесса, поэтому
+# кнопка со старой клавиатуры или из старого маршрута не попадёт в чужую доставку
+_DELIVERY_IDS = count()
+
+
+@dataclass(slots=True)
+class Delivery:
+    name: str
+    surname: str
+    order: str
+    floor: int
+    room: str
+    # Строка маршрута и ключ сортировки считаются один раз, а не на каждый перерендер
+    line: str = field(init=False)
+    sortkey: tuple = field(init=False)
+    uid: int = field(init=False)
+    # Номер в тексте маршрута; кнопки показывают его же, чтобы после отметок
+    # клавиатура совпадала с неизменным текстом
+    num: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        self.uid = next(_DELIVERY_IDS)
+        self.line = ROUTE_ITEM.format(self.name, self.room, self.order)
+        self.sortkey = (self.floor, _parse_room_num(self.room))
+
+
 def optimize_route(deliveries: list) -> list:
-    def key(d):
-        floor = d.get("floor", 99)
-        room = d.get("room", "99.99")
-        try:
-            room_num = int(room.split(".")[1])
-        except:
-            room_num = 99
-        return (floor, room_num)
-    return sorted(deliveries, key=key)
-
-
-def format_route(deliveries: list) -> str:
+    return sorted(deliveries, key=operator.attrgetter("sortkey"))
+
+
+CLEAR_ROUTE_ROW = [InlineKeyboardButton("🗑 Очистить маршрут", callback_data="done:clear")]
+
+
+def _route_row(d: Delivery, cache: dict) -> list:
+    # Кнопки неизменяемы, а подпись и callback_data доставки не меняются после
+    # первой отрисовки, поэтому ряд строится один раз на доставку
+    row = cache.get(d.uid)
+    if row is None:
+        row = cache[d.uid] = [InlineKeyboardButton(
+            f"✅ {d.num}. {d.name} · ком. {d.room}",
+            callback_data=f"done:{d.uid}"
+        )]
+    return row
+
+
+def build_route_keyboard(deliveries: list, cache: dict) -> InlineKeyboardMarkup:
+    """Только клавиатура — когда текст маршрута перерисовывать не нужно."""
+    keyboard = [_route_row(d, cache) for d in deliveries]
+    keyboard.append(CLEAR_ROUTE_ROW)
+    return InlineKeyboardMarkup(keyboard)
+
+
+def render_route(deliveries: list, cache: dict) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст маршрута и клавиатура к нему за один проход по доставкам."""
     if not deliveries:
-        return "Список пуст."
-    lines = ["🗺 *МАРШРУТ*\n"]
+        return "Список пуст.", InlineKeyboardMarkup([CLEAR_ROUTE_ROW])
+    lines = [ROUTE_HEADER]
+    keyboard = []
+    floors_seen = set()
     current_floor = None
     for i, d in enumerate(deliveries, 1):
-        floor = d.get("floor", "?")
+        floor = d.floor
         if floor != current_floor:
             if current_floor is not None:
                 lines.append("")
-            lines.append(f"🔼 *Этаж {floor}*")
+            lines.append(ROUTE_FLOOR.format(floor))
             current_floor = floor
-        lines.append(f"  {i}\\. {d['name']} — ком\\. {d['room']} \\| заказ \\#{d['order']}")
-    floors_count = len(set(d.get("floor") for d in deliveries))
-    lines.append(f"\n📦 Итого: {len(deliveries)} доставок, {floors_count} этажей")
-    return "\n".join(lines)
-
-
-def build_route_keyboard(deliveries: list) -> InlineKeyboardMarkup:
-    keyboard = []
-    for i, d in enumerate(deliveries):
-        keyboard.append([InlineKeyboardButton(
-            f"✅ {i+1}. {d['name']} · ком. {d['room']}",
-            callback_data=f"done:{i}"
-        )])
-    keyboard.append([InlineKeyboardButton("🗑 Очистить маршрут", callback_data="done:clear")])
-    return InlineKeyboardMarkup(keyboard)
+            floors_seen.add(floor)
+        d.num = i
+        lines.append(ROUTE_LINE.format(i, d.line))
+        keyboard.append(_route_row(d, cache))
+    lines.append(ROUTE_TOTAL.format(len(deliveries), len(floors_seen)))
+    keyboard.append(CLEAR_ROUTE_ROW)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
 
 
 # ─────────────────────────────────────────────────────────
 # СЕССИЯ (хранится в user_data)
 # ─────────────────────────────────────────────────────────
 
+def new_session() -> dict:
+    # _btn_cache: uid доставки -> ряд клавиатуры маршрута
+    return {"deliveries": [], "pending": [], "current": None, "_btn_cache": {}}
+
 def get_session(context: ContextTypes.DEFAULT_TYPE) -> dict:
     if "session" not in context.user_data:
-        context.user_data["session"] = {"deliveries": [], "pending": [], "current": None}
+        context.user_data["session"] = new_session()
     return context.user_data["session"]
 
 def clear_session(context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["session"] = {"deliveries": [], "pending": [], "current": None}
+    cancel_pending_edit(context)
+    context.user_data.pop("state", None)
+    _clear_manual_add(context)
+    context.user_data["session"] = new_session()
+
+def cancel_pending_edit(context: ContextTypes.DEFAULT_TYPE):
+    task = context.user_data.pop("_pending_edit", None)
+    if task is not None:
+        task.cancel()
+
+def _clear_manual_add(context: ContextTypes.DEFAULT_TYPE):
+    for key in ("manual_add", "manual_name", "manual_floor"):
+        context.user_data.pop(key, None)
+
+def per_user(handler):
+    """Апдейты одного пользователя — по очереди (общая сессия), разных — параллельно."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        lock = context.user_data.setdefault("_lock", asyncio.Lock())
+        async with lock:
+            return await handler(update, context)
+    return wrapper
 
 
 # ─────────────────────────────────────────────────────────
@@ -149,46 +346,40 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = load_db()
-    if not db:
+    employees = await list_employees()
+    if not employees:
         await update.message.reply_text(
             "📭 База пустая\\. Пришли отбивку — заполнится автоматически\\.",
             parse_mode="MarkdownV2"
         )
         return
 
-    by_floor = {}
-    for surname, info in db.items():
-        floor = info.get("floor", "?")
-        by_floor.setdefault(floor, []).append((surname, info))
-
     lines = ["📋 *СОТРУДНИКИ В БАЗЕ*\n"]
-    for floor in sorted(by_floor.keys(), key=lambda x: (str(x) == "?", x)):
-        lines.append(f"🔼 *Этаж {floor}*")
-        for surname, info in sorted(by_floor[floor], key=lambda x: x[1].get("room", "")):
-            full_name = info.get("full_name", surname.capitalize())
-            room = info.get("room", "?")
-            lines.append(f"  • {full_name} — ком\\. {room}")
+    for floor, rows in groupby(employees, key=operator.itemgetter(2)):
+        lines.append(f"🔼 *Этаж {'?' if floor is None else floor}*")
+        for surname, full_name, _, room in rows:
+            lines.append(f"  • {full_name or surname.capitalize()} — ком\\. {room or '?'}")
         lines.append("")
-    lines.append(f"_Всего: {len(db)} чел\\._")
+    lines.append(f"_Всего: {len(employees)} чел\\._")
 
     await update.message.reply_text("\n".join(lines), parse_mode="MarkdownV2")
 
 
+@per_user
 async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     clear_session(context)
     await update.message.reply_text("🗑 Маршрут очищен\\. Пришли новую отбивку\\.", parse_mode="MarkdownV2")
 
 
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db = load_db()
-    if not db:
+    employees = await list_employees()
+    if not employees:
         await update.message.reply_text("База пустая.")
         return
     keyboard = []
-    for surname in sorted(db.keys()):
-        full_name = db[surname].get("full_name", surname.capitalize())
-        room = db[surname].get("room", "?")
+    for surname, full_name, _, room in sorted(employees):
+        full_name = full_name or surname.capitalize()
+        room = room or "?"
         keyboard.append([InlineKeyboardButton(
             f"❌ {full_name} (ком. {room})",
             callback_data=f"del:{surname}"
@@ -204,11 +395,8 @@ async def cb_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Отменено.")
         return
     surname = query.data[4:]
-    db = load_db()
-    if surname in db:
-        name = db[surname].get("full_name", surname)
-        del db[surname]
-        save_db(db)
+    name = await delete_employee(surname)
+    if name is not None:
         await query.edit_message_text(f"✅ {name} удалён.")
     else:
         await query.edit_message_text("Не найден.")
@@ -218,37 +406,60 @@ async def cb_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # CALLBACK: отметить доставку
 # ─────────────────────────────────────────────────────────
 
+# Быстрые нажатия подряд сливаются в одно редактирование сообщения.
+# Текст маршрута остаётся прежним (номера на кнопках совпадают с ним),
+# меняется только клавиатура; подтверждение показывается всплывашкой.
+EDIT_DELAY = 0.1
+
+async def _delayed_edit(query, deliveries: list, btn_cache: dict, user_data: dict):
+    await asyncio.sleep(EDIT_DELAY)
+    # Задержка прошла — запрос уже не отменяем, следующее нажатие
+    # запланирует своё редактирование
+    user_data.pop("_pending_edit", None)
+    keyboard = build_route_keyboard(deliveries, btn_cache)
+    await query.edit_message_reply_markup(reply_markup=keyboard)
+
+
+@per_user
 async def cb_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
 
     if query.data == "done:clear":
+        await query.answer()
         clear_session(context)
         await query.edit_message_text("🗑 Маршрут очищен.")
         return
 
-    idx = int(query.data[5:])
+    uid = int(query.data[5:])
     session = get_session(context)
     deliveries = session.get("deliveries", [])
 
-    if idx >= len(deliveries):
+    # Ищем по uid, а не по позиции: пока клавиатура не перерисована,
+    # на экране старые номера, а список уже сдвинулся
+    idx = next((i for i, d in enumerate(deliveries) if d.uid == uid), None)
+    if idx is None:
+        await query.answer("Уже отмечено")
         return
 
     done = deliveries.pop(idx)
+    session["_btn_cache"].pop(done.uid, None)
+    # Отменяем и планируем до первого await: иначе за время ответа на нажатие
+    # отложенное редактирование успевает уйти и нажатия не сливаются
+    cancel_pending_edit(context)
+    if deliveries:
+        # Через application.create_task ошибки редактирования уходят в error handlers PTB
+        context.user_data["_pending_edit"] = context.application.create_task(
+            _delayed_edit(query, deliveries, session["_btn_cache"], context.user_data),
+            update=update
+        )
+    await query.answer(f"✅ {done.name} — доставлено")
 
     if not deliveries:
         await query.edit_message_text(
-            f"✅ *{done['name']}* — доставлено\\!\n\n🎉 *Все заказы выполнены\\!*",
+            f"✅ *{done.name}* — доставлено\\!\n\n🎉 *Все заказы выполнены\\!*",
             parse_mode="MarkdownV2"
         )
         clear_session(context)
-        return
-
-    await query.edit_message_text(
-        f"✅ _{done['name']}_ доставлено\\!\n\n" + format_route(deliveries),
-        parse_mode="MarkdownV2",
-        reply_markup=build_route_keyboard(deliveries)
-    )
 
 
 # ─────────────────────────────────────────────────────────
@@ -265,23 +476,27 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "`батталова 0835`\n`погудин 2397`",
             parse_mode="MarkdownV2"
         )
-        return ConversationHandler.END
+        return None
 
-    db = load_db()
+    db = await get_employees([item["surname"] for item in parsed])
     session = get_session(context)
     session["deliveries"] = []
     session["pending"] = []
     session["current"] = None
+    session["_btn_cache"] = {}
 
     known, unknown = [], []
     for item in parsed:
-        if item["surname"] in db:
-            emp = db[item["surname"]]
-            known.append({**item,
-                "name": emp.get("full_name", item["name"].capitalize()),
-                "floor": emp["floor"],
-                "room": emp["room"],
-            })
+        emp = db.get(item["surname"])
+        # Сотрудника без этажа или комнаты не отсортировать — спрашиваем как неизвестного
+        if emp is not None and emp["floor"] is not None and emp["room"] is not None:
+            known.append(Delivery(
+                name=emp["full_name"] or item["name"].capitalize(),
+                surname=item["surname"],
+                order=item["order"],
+                floor=emp["floor"],
+                room=emp["room"],
+            ))
         else:
             unknown.append(item)
 
@@ -290,12 +505,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not unknown:
         route = optimize_route(known)
         session["deliveries"] = route
+        text, keyboard = render_route(route, session["_btn_cache"])
         await update.message.reply_text(
-            format_route(route),
+            text,
             parse_mode="MarkdownV2",
-            reply_markup=build_route_keyboard(route)
+            reply_markup=keyboard
         )
-        return ConversationHandler.END
+        return None
 
     session["pending"] = unknown[1:]
     session["current"] = unknown[0]
@@ -330,21 +546,15 @@ async def got_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     item["room"] = room
 
     # Сохраняем в базу
-    db = load_db()
-    db[item["surname"]] = {
-        "full_name": item["name"].capitalize(),
-        "floor": item["floor"],
-        "room": room,
-    }
-    save_db(db)
-
-    session["deliveries"].append({
-        "name": item["name"].capitalize(),
-        "surname": item["surname"],
-        "order": item["order"],
-        "floor": item["floor"],
-        "room": room,
-    })
+    await save_employee(item["surname"], item["name"].capitalize(), item["floor"], room)
+
+    session["deliveries"].append(Delivery(
+        name=item["name"].capitalize(),
+        surname=item["surname"],
+        order=item["order"],
+        floor=item["floor"],
+        room=room,
+    ))
 
     await update.message.reply_text(
         f"✅ *{item['name'].capitalize()}* сохранён — этаж {item['floor']}, ком\\. {room}",
@@ -362,41 +572,71 @@ async def got_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         route = optimize_route(session["deliveries"])
         session["deliveries"] = route
+        text, keyboard = render_route(route, session["_btn_cache"])
         await update.message.reply_text(
-            format_route(route),
+            text,
             parse_mode="MarkdownV2",
-            reply_markup=build_route_keyboard(route)
+            reply_markup=keyboard
         )
-        return ConversationHandler.END
+        return None
 
 
+@per_user
 async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Введи фамилию сотрудника \\(строчными\\):\n\n`батталова`",
         parse_mode="MarkdownV2"
     )
+    _clear_manual_add(context)
     context.user_data["manual_add"] = True
-    return ASK_FLOOR
+    context.user_data["state"] = ADD_FLOOR
 
 
 async def got_floor_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("manual_add") and "manual_name" not in context.user_data:
         # Это ответ на имя
         name = update.message.text.strip()
+        if not name:
+            return ADD_FLOOR
         context.user_data["manual_name"] = name
         await update.message.reply_text(
             f"*{name.capitalize()}* — этаж?",
             parse_mode="MarkdownV2"
         )
-        return ASK_FLOOR
+        return ADD_FLOOR
 
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("Введи число этажа:", parse_mode="MarkdownV2")
-        return ASK_FLOOR
+        return ADD_FLOOR
     context.user_data["manual_floor"] = int(text)
     await update.message.reply_text(f"Этаж {text} ✅\n\nКомната? \\(напр\\. `7\\.47`\\)", parse_mode="MarkdownV2")
-    return ASK_ROOM
+    return ADD_ROOM
+
+
+async def got_room_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    room = update.message.text.strip()
+    name = context.user_data["manual_name"]
+    floor = context.user_data["manual_floor"]
+    full_name = name.capitalize()
+    await save_employee(normalize(name.split()[0]), full_name, floor, room)
+    _clear_manual_add(context)
+    await update.message.reply_text(f"✅ {full_name} сохранён — этаж {floor}, ком. {room}")
+    return None
+
+
+TEXT_HANDLERS = {
+    ASK_FLOOR: got_floor,
+    ASK_ROOM: got_room,
+    ADD_FLOOR: got_floor_manual,
+    ADD_ROOM: got_room_manual,
+}
+
+
+@per_user
+async def dispatch_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = TEXT_HANDLERS.get(context.user_data.get("state"), handle_text)
+    context.user_data["state"] = await handler(update, context)
 
 
 # ─────────────────────────────────────────────────────────
@@ -407,19 +647,21 @@ def main():
     if not TOKEN:
         raise ValueError("Установи BOT_TOKEN в переменных окружения!")
 
-    app = Application.builder().token(TOKEN).build()
-
-    conv = ConversationHandler(
-        entry_points=[
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text),
-            CommandHandler("add", cmd_add),
-        ],
-        states={
-            ASK_FLOOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, got_floor)],
-            ASK_ROOM:  [MessageHandler(filters.TEXT & ~filters.COMMAND, got_room)],
-        },
-        fallbacks=[CommandHandler("clear", cmd_clear)],
-        allow_reentry=True,
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    from telegram.ext import (
+        Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    )
+
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .post_init(warm_db)
+        .post_shutdown(close_db)
+        .build()
     )
 
     app.add_handler(CommandHandler("start", cmd_start))
@@ -428,7 +670,8 @@ def main():
     app.add_handler(CommandHandler("delete", cmd_delete))
     app.add_handler(CallbackQueryHandler(cb_delete, pattern=r"^del:"))
     app.add_handler(CallbackQueryHandler(cb_done, pattern=r"^done:"))
-    app.add_handler(conv)
+    app.add_handler(CommandHandler("add", cmd_add))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, dispatch_text))
 
     logger.info("Бот запущен")
     app.run_polling(drop_pending_updates=True)